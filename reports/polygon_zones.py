@@ -0,0 +1,209 @@
+"""
+Polygon zones for filtering trips by real city areas instead of a bounding box.
+
+Zones are loaded from GeoJSON or WKT and kept as numpy rings of (lon, lat). A
+grid index sends each point only to the zones whose cells it falls in, and the
+point-in-polygon test runs vectorized over the candidate points, so tens of
+millions of origin/destination points can be assigned to hundreds of zones in
+one pass.
+"""
+
+import json
+import re
+import numpy as np
+import pandas as pd
+
+GRID_CELL_SIZE = 0.01  # grid cell size in degrees (~1 km)
+NO_ZONE = -1  # zone code for points outside every zone
+
+
+def _rings_from_coordinates(polygon_coordinates):
+    """Converts GeoJSON polygon coordinates to a list of (lon, lat) numpy rings."""
+    return [np.asarray(ring, dtype=float)[:, :2] for ring in polygon_coordinates]
+
+
+def load_zones_geojson(file_path, name_property="name"):
+    """
+    Loads Polygon and MultiPolygon features from a GeoJSON file.
+    Returns a dict of zone name -> list of polygons (each one a list of rings).
+    """
+
+    with open(file_path, "r") as geojson_file:
+        geojson = json.load(geojson_file)
+
+    features = geojson["features"] if "features" in geojson else [geojson]
+
+    zones = {}
+    for position, feature in enumerate(features):
+        geometry = feature["geometry"]
+        properties = feature.get("properties") or {}  # may be null in GeoJSON
+        name = properties.get(name_property) or f"zone_{position}"  # missing or null name
+
+        if geometry["type"] == "Polygon":
+            polygons = [_rings_from_coordinates(geometry["coordinates"])]
+        elif geometry["type"] == "MultiPolygon":
+            polygons = [_rings_from_coordinates(p) for p in geometry["coordinates"]]
+        else:
+            raise ValueError(f'Unsupported geometry type "{geometry["type"]}".')
+
+        zones.setdefault(name, []).extend(polygons)
+
+    return zones
+
+
+def _parse_wkt_ring(ring_text):
+    """Parses '(lon lat, lon lat, ...)' into a numpy ring."""
+    points = [point.split() for point in ring_text.strip("() ").split(",")]
+    return np.array([[float(lon), float(lat)] for lon, lat, *_ in points])
+
+
+def load_zones_wkt(wkt_zones):
+    """
+    Loads POLYGON and MULTIPOLYGON zones from a dict of zone name -> WKT string.
+    Returns the same structure as load_zones_geojson.
+    """
+
+    zones = {}
+    for name, wkt in wkt_zones.items():
+        wkt = wkt.strip()
+        geometry_type = wkt.split("(", 1)[0].strip().upper()
+
+        if geometry_type not in ("POLYGON", "MULTIPOLYGON"):
+            raise ValueError(f'Unsupported WKT geometry "{geometry_type}".')
+
+        # every polygon is a group of rings: ((ring), (ring), ...)
+        body = wkt[wkt.index("(") :]
+        if geometry_type == "POLYGON":
+            polygon_texts = [body[1:-1]]
+        else:
+            polygon_texts = re.findall(
+                r"\((\([^()]*\)(?:\s*,\s*\([^()]*\))*)\)", body[1:-1]
+            )
+
+        zones[name] = [
+            [_parse_wkt_ring(ring) for ring in re.findall(r"\([^()]*\)", polygon)]
+            for polygon in polygon_texts
+        ]
+
+    return zones
+
+
+def coordinates_to_arrays(coordinates):
+    """Extracts lon and lat float arrays from a Series of 'POINT(lon lat)' strings."""
+
+    lon_lat = coordinates.astype(str).str.extract(
+        r"POINT\s*\(\s*([-0-9.eE+]+)\s+([-0-9.eE+]+)\s*\)"
+    )
+    lon_lat = lon_lat.astype(float)
+    return lon_lat[0].to_numpy(), lon_lat[1].to_numpy()
+
+
+def points_in_polygon(lon, lat, polygon):
+    """
+    Vectorized even-odd point-in-polygon test. Holes are handled naturally,
+    since crossing a hole ring flips the result back to outside.
+    """
+
+    inside = np.zeros(len(lon), dtype=bool)
+
+    for ring in polygon:
+        x1, y1 = ring[:, 0], ring[:, 1]
+        x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+
+        for edge in range(len(ring)):
+            crosses = (y1[edge] > lat) != (y2[edge] > lat)
+            if not crosses.any():
+                continue
+            slope = (x2[edge] - x1[edge]) / (y2[edge] - y1[edge])
+            x_intersection = x1[edge] + (lat - y1[edge]) * slope
+            inside ^= crosses & (lon < x_intersection)
+
+    return inside
+
+
+def build_zone_index(zones, cell_size=GRID_CELL_SIZE):
+    """
+    Builds a grid index over the zones. Each polygon remembers the grid cells
+    covered by its bounding box, so only the points inside those cells are tested.
+    """
+
+    names = list(zones)
+    polygons = []
+
+    for code, name in enumerate(names):
+        for polygon in zones[name]:
+            exterior = polygon[0]
+            min_lon, min_lat = exterior.min(axis=0)
+            max_lon, max_lat = exterior.max(axis=0)
+            polygons.append(
+                {
+                    "code": code,
+                    "rings": polygon,
+                    "cells_x": (
+                        int(np.floor(min_lon / cell_size)),
+                        int(np.floor(max_lon / cell_size)),
+                    ),
+                    "cells_y": (
+                        int(np.floor(min_lat / cell_size)),
+                        int(np.floor(max_lat / cell_size)),
+                    ),
+                }
+            )
+
+    return {"names": names, "polygons": polygons, "cell_size": cell_size}
+
+
+def assign_zone_codes(lon, lat, zone_index):
+    """
+    Returns the zone code of each point (NO_ZONE when outside every zone).
+    When zones overlap, the first zone in the index wins.
+    """
+
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    codes = np.full(len(lon), NO_ZONE, dtype=np.int32)
+
+    valid = ~(np.isnan(lon) | np.isnan(lat))
+    valid_positions = np.flatnonzero(valid)
+
+    # sort points by grid row once, so each polygon reads a contiguous slice
+    cell_size = zone_index["cell_size"]
+    cell_x = np.floor(lon[valid_positions] / cell_size).astype(np.int64)
+    cell_y = np.floor(lat[valid_positions] / cell_size).astype(np.int64)
+    order = np.argsort(cell_y, kind="stable")
+    sorted_positions = valid_positions[order]
+    sorted_y = cell_y[order]
+    sorted_x = cell_x[order]
+
+    for polygon in zone_index["polygons"]:
+        start, stop = np.searchsorted(
+            sorted_y, [polygon["cells_y"][0], polygon["cells_y"][1] + 1]
+        )
+        if start == stop:
+            continue
+
+        row_x = sorted_x[start:stop]
+        in_cells = (row_x >= polygon["cells_x"][0]) & (row_x <= polygon["cells_x"][1])
+        candidates = sorted_positions[start:stop][in_cells]
+
+        # skip points already assigned to an earlier zone
+        candidates = candidates[codes[candidates] == NO_ZONE]
+        if len(candidates) == 0:
+            continue
+
+        inside = points_in_polygon(lon[candidates], lat[candidates], polygon["rings"])
+        codes[candidates[inside]] = polygon["code"]
+
+    return codes
+
+
+def assign_zones(coordinates, zone_index):
+    """Assigns a Series of 'POINT(lon lat)' strings to zone names (NaN if no zone)."""
+
+    lon, lat = coordinates_to_arrays(coordinates)
+    codes = assign_zone_codes(lon, lat, zone_index)
+
+    return pd.Series(
+        pd.Categorical.from_codes(codes, categories=zone_index["names"]),
+        index=coordinates.index,
+    )
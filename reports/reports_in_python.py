@@ -1,10 +1,19 @@
+import os
 import re
+import sys
 import time
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from dotenv import load_dotenv
 from google.cloud import bigquery
 from google.oauth2 import service_account
+from polygon_zones import assign_zones, build_zone_index, load_zones_geojson
+from trip_clustering import cluster_similar_trips
+
+# shared reader of the local Parquet copy written by src/process_data.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from local_mirror import local_mirror_is_current, read_local_mirror, trips_query
 
 # variables
 PROJECT_ID = "data-project-452300"
@@ -13,21 +22,55 @@ TABLE_NAME = "raw_trips"
 TABLE_ID = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_NAME}"
 SERVICE_ACCOUNT_FILE = r"data-project-452300-e2c341ffd483.json"
 FILE_PATH = "trips.csv"
+ZONES_FILE = "zones.geojson"  # optional polygon zones (GeoJSON)
 CHUNK_SIZE = 30  # load data in chuncks
+SIMILAR_TRIP_RADIUS_M = 500  # max distance between similar origins/destinations
+SIMILAR_TRIP_WINDOW_MINUTES = 30  # max time between similar departures
+
+bq_client = None
 
-# set GCP credentials
-credentials = service_account.Credentials.from_service_account_file(
-    SERVICE_ACCOUNT_FILE
-)
-bq_client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
 
+def get_bq_client():
+    """Sets GCP credentials only when BigQuery is really needed."""
+    global bq_client
+
+    if bq_client is None:
+        credentials = service_account.Credentials.from_service_account_file(
+            SERVICE_ACCOUNT_FILE
+        )
+        bq_client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
+    return bq_client
 
-def query_bigquery_table(query):
+
+def query_bigquery_table(query, job_config=None):
     """Runs a SQL query on BigQuery and returns results as a DataFrame."""
-    query_job = bq_client.query(query)  # Run the query
+    query_job = get_bq_client().query(query, job_config=job_config)  # Run the query
     return query_job.to_dataframe()  # Convert result to Pandas DataFrame
 
 
+def load_trips(
+    columns=None, start_date=None, end_date=None, regions=None, source="auto"
+):
+    """
+    Loads trips from the local Parquet copy when it is up to date with raw_trips
+    (or source="local"), otherwise from BigQuery. Date (inclusive) and region
+    filters and the column list are pushed down to both.
+    """
+
+    if source == "auto":
+        current = local_mirror_is_current(get_bq_client(), TABLE_ID)
+        source = "local" if current else "bigquery"
+
+    if source == "local":
+        return read_local_mirror(
+            columns=columns, start_date=start_date, end_date=end_date, regions=regions
+        )
+
+    return query_bigquery_table(
+        *trips_query(TABLE_ID, columns, start_date, end_date, regions)
+    )
+
+
 def create_trips_table(ddl_file):
     """Creates the trip table on big query."""
 
@@ -49,7 +92,9 @@ def load_table_to_bigquery(df, table_id):
             autodetect=True,
         )
 
-        job = bq_client.load_table_from_dataframe(df, table_id, job_config=job_config)
+        job = get_bq_client().load_table_from_dataframe(
+            df, table_id, job_config=job_config
+        )
         job.result()
 
         duration = time.time() - start_time
@@ -126,7 +171,17 @@ def round_coordinate(coordinate):
     return round(latitude, 1), round(longitude, 1)
 
 
-def group_similar_trips(df):
+def group_similar_trips(
+    df,
+    method="grid",
+    radius_m=SIMILAR_TRIP_RADIUS_M,
+    window_minutes=SIMILAR_TRIP_WINDOW_MINUTES,
+):
+    if method not in ("grid", "proximity"):
+        raise ValueError('Invalid "method" parameter. Choose "grid" or "proximity".')
+
+    if method == "proximity":
+        return group_similar_trips_by_proximity(df, radius_m, window_minutes)
 
     # extract hour and categorize time of day
     df["time_of_day"] = df["datetime"].dt.hour.apply(get_time_of_day)
@@ -174,7 +229,63 @@ def group_similar_trips(df):
     return grouped_df
 
 
-def weekly_avg_trips(df, bounding_box=None, region=None, location_filter="origin"):
+def group_similar_trips_by_proximity(
+    df,
+    radius_m=SIMILAR_TRIP_RADIUS_M,
+    window_minutes=SIMILAR_TRIP_WINDOW_MINUTES,
+):
+    """
+    Groups trips whose origins and destinations are each within radius_m meters
+    and whose departures are within window_minutes of the first trip of the group.
+    Returns the same columns as grouped_trips plus cluster_id, with the mean
+    coordinates of each cluster.
+    """
+
+    clustered = cluster_similar_trips(df, radius_m, window_minutes)
+    clustered = clustered.loc[clustered["cluster_id"] >= 0]
+
+    grouped_df = (
+        clustered.sort_values("datetime")
+        .groupby("cluster_id")
+        .agg(
+            region=("region", "first"),
+            first_datetime=("datetime", "first"),  # earliest departure
+            origin_latitude=("origin_latitude", "mean"),
+            origin_longitude=("origin_longitude", "mean"),
+            destination_latitude=("destination_latitude", "mean"),
+            destination_longitude=("destination_longitude", "mean"),
+            trip_count=("datasource", "count"),  # Count trips
+            # concatenate cars that would do the same trip at a similar time
+            datasources=("datasource", lambda x: ", ".join(sorted(set(x)))),
+        )
+        .reset_index()
+    )
+
+    # time of day of the earliest departure of each cluster
+    grouped_df.insert(
+        2,
+        "time_of_day",
+        pd.to_datetime(grouped_df.pop("first_datetime")).dt.hour.apply(
+            get_time_of_day
+        ),
+    )
+    grouped_df = grouped_df.sort_values("trip_count", ascending=False)
+
+    # filter trips where trip_count > 1 and print
+    multiple_trips = grouped_df[grouped_df["trip_count"] > 1]
+
+    print("##################################################################")
+    print(
+        f"\nTrips with origin and destination within {radius_m} m and departures within {window_minutes} minutes are now grouped. These are grouped the trips:\n"
+    )
+    print(multiple_trips, "\n")
+
+    return grouped_df
+
+
+def weekly_avg_trips(
+    df, bounding_box=None, region=None, location_filter="origin", zone_index=None
+):
     if location_filter not in ("origin", "destination", "both"):
         raise ValueError(
             'Invalid "location_filter" parameter. Choose "origin", "destination", or "both".'
@@ -216,6 +327,24 @@ def weekly_avg_trips(df, bounding_box=None, region=None, location_filter="origin
             )
         df = df.loc[mask].copy()
 
+    # apply polygon filter (trips inside any zone of the index)
+    if zone_index:
+        # only test the side(s) the filter needs
+        # (positional masks, so duplicated index labels are fine)
+        if location_filter in ("origin", "both"):
+            origins = assign_zones(df["origin_coord"], zone_index)
+            mask = origins.notna().to_numpy(copy=True)
+        else:
+            mask = np.zeros(len(df), dtype=bool)
+
+        if location_filter in ("destination", "both"):
+            # with "both", trips whose origin is in a zone are already kept
+            outside = np.flatnonzero(~mask)
+            destinations = df["destination_coord"].iloc[outside]
+            mask[outside] = assign_zones(destinations, zone_index).notna().to_numpy()
+
+        df = df.loc[mask].copy()
+
     # apply region filter
     if region:
         df = df.loc[df["region"] == region].copy()
@@ -240,6 +369,46 @@ def weekly_avg_trips(df, bounding_box=None, region=None, location_filter="origin
     return weekly_avg
 
 
+def weekly_avg_trips_per_zone(df, zone_index, location_filter="origin"):
+    """
+    Computes the weekly average trips of every zone in one pass.
+    Each trip is assigned to its zone, so hundreds of zones cost a single scan.
+    """
+    if location_filter not in ("origin", "destination", "both"):
+        raise ValueError(
+            'Invalid "location_filter" parameter. Choose "origin", "destination", or "both".'
+        )
+
+    datetime = pd.to_datetime(df["datetime"]).dt.tz_localize(None)
+    week_year = datetime.dt.to_period("W").astype(str)
+
+    columns = {
+        "origin": ["origin_coord"],
+        "destination": ["destination_coord"],
+        "both": ["origin_coord", "destination_coord"],
+    }[location_filter]
+
+    zone_trips = pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "trip": np.arange(len(df)),  # index labels may repeat
+                    "zone": assign_zones(df[column], zone_index),
+                    "week_year": week_year,
+                }
+            )
+            for column in columns
+        ]
+    )
+
+    # with "both" a trip inside the same zone at origin and destination counts once
+    zone_trips = zone_trips.dropna(subset=["zone"]).drop_duplicates(["trip", "zone"])
+
+    weekly_trips = zone_trips.groupby(["zone", "week_year"], observed=True).size()
+
+    return weekly_trips.groupby(level="zone", observed=True).mean()
+
+
 def print_weekle_average_trips_cenarios():
 
     print("#################################################################\n")
@@ -270,18 +439,26 @@ def print_weekle_average_trips_cenarios():
     weekly_avg = weekly_avg_trips(df, location_filter="both", region="Hamburg")
     print(f"\nFor Hamburg region - Weekly Average Trips (both): {weekly_avg:.2f}")
 
+    if os.path.exists(ZONES_FILE):
+        print("\n#################################################################")
 
-if __name__ == "__main__":
+        # compute weekly average for every polygon zone based on origin
+        zone_index = build_zone_index(load_zones_geojson(ZONES_FILE))
+        weekly_avg = weekly_avg_trips_per_zone(df, zone_index, location_filter="origin")
+        print(f"\nWeekly Average Trips per zone (origin):\n{weekly_avg.round(2)}")
 
-    # query to get all records from trips table
-    query = f"SELECT * FROM `{TABLE_ID}`"
 
-    # run query and store results in a DataFrame
-    df = query_bigquery_table(query)
+if __name__ == "__main__":
+
+    # get all records from the local Parquet copy or the trips table
+    df = load_trips()
 
     table_id = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_NAME}"
 
     # calculate and print similar group trips
     df_similar_trips = group_similar_trips(df)
 
+    # calculate and print similar group trips by distance and departure time
+    df_close_trips = group_similar_trips(df, method="proximity")
+
     print_weekle_average_trips_cenarios()
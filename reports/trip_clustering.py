@@ -0,0 +1,141 @@
+"""
+Proximity clustering of similar trips.
+
+Two trips match when their origins are within radius_m meters, their destinations
+are within radius_m meters and their departures are within window_minutes of each
+other. Each cluster is a seed trip with its matching trips, so unlike the 0.1
+degree grid, trips close to a cell edge are still grouped together, and clusters
+never chain into groups wider than the radius and the window.
+
+Neighbors come from a KD-tree over (origin, destination, time) scaled so that
+one unit is the radius or the window, which keeps the search O(n log n) instead
+of comparing every pair of trips.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from polygon_zones import coordinates_to_arrays
+
+EARTH_RADIUS_M = 6371000
+NEIGHBOR_BLOCK_SIZE = 256  # trips whose neighbors are searched at once
+
+
+def project_to_meters(lon, lat, reference_lat):
+    """Projects lon/lat to local x/y meters (equirectangular, fine at city scale)."""
+
+    x = EARTH_RADIUS_M * np.radians(lon) * np.cos(np.radians(reference_lat))
+    y = EARTH_RADIUS_M * np.radians(lat)
+    return x, y
+
+
+def cluster_trip_ids(origin, destination, minutes, radius_m, window_minutes):
+    """
+    Returns a cluster id per trip. origin and destination are (n, 2) arrays of
+    x/y meters and minutes is the departure time of each trip in minutes.
+
+    Trips are visited in departure order. Each trip not yet in a cluster becomes
+    the seed of a new cluster with its unassigned matching trips, so every member
+    is within radius_m and window_minutes of the seed (the earliest trip).
+    """
+
+    n_trips = len(minutes)
+    labels = np.full(n_trips, -1, dtype=np.int64)
+    if n_trips == 0:
+        return labels
+
+    # with the Chebyshev distance, a trip within 1 unit is within the radius on
+    # every axis, so the KD-tree returns a superset of the matching trips
+    points = np.column_stack(
+        [origin / radius_m, destination / radius_m, minutes / window_minutes]
+    )
+    tree = cKDTree(points)
+    order = np.argsort(minutes, kind="stable")
+
+    next_label = 0
+    position = 0
+    while position < n_trips:
+        # next block of trips still without a cluster, in departure order
+        block = []
+        while position < n_trips and len(block) < NEIGHBOR_BLOCK_SIZE:
+            if labels[order[position]] < 0:
+                block.append(order[position])
+            position += 1
+        if not block:
+            break
+
+        # neighbors are searched a block at a time to bound memory in hotspots
+        block_neighbors = tree.query_ball_point(points[block], r=1.0, p=np.inf)
+
+        for seed, neighbors in zip(block, block_neighbors):
+            if labels[seed] >= 0:
+                continue
+
+            labels[seed] = next_label
+            if len(neighbors) > 1:
+                neighbors = np.asarray(neighbors)
+                neighbors = neighbors[labels[neighbors] < 0]
+                matches = (
+                    (np.hypot(*(origin[neighbors] - origin[seed]).T) <= radius_m)
+                    & (
+                        np.hypot(*(destination[neighbors] - destination[seed]).T)
+                        <= radius_m
+                    )
+                    & (np.abs(minutes[neighbors] - minutes[seed]) <= window_minutes)
+                )
+                labels[neighbors[matches]] = next_label
+            next_label += 1
+
+    return labels
+
+
+def cluster_similar_trips(df, radius_m=500, window_minutes=30):
+    """
+    Adds a cluster_id column to the trips, clustering each region separately.
+    Trips with missing coordinates or datetime get cluster_id -1.
+    """
+
+    df = df.copy()
+    df["cluster_id"] = -1
+
+    origin_lon, origin_lat = coordinates_to_arrays(df["origin_coord"])
+    destination_lon, destination_lat = coordinates_to_arrays(df["destination_coord"])
+    datetime = pd.to_datetime(df["datetime"])
+    minutes = (
+        datetime.dt.tz_localize(None) - pd.Timestamp("1970-01-01")
+    ) / pd.Timedelta(minutes=1)
+    minutes = minutes.to_numpy()
+
+    valid = ~(
+        np.isnan(origin_lon)
+        | np.isnan(destination_lon)
+        | np.isnan(minutes)
+        | df["region"].isna().to_numpy()
+    )
+
+    next_cluster_id = 0
+    for _, positions in df.loc[valid].groupby("region").indices.items():
+        positions = np.flatnonzero(valid)[positions]
+        reference_lat = np.mean(origin_lat[positions])
+
+        origin = np.column_stack(
+            project_to_meters(origin_lon[positions], origin_lat[positions], reference_lat)
+        )
+        destination = np.column_stack(
+            project_to_meters(
+                destination_lon[positions], destination_lat[positions], reference_lat
+            )
+        )
+
+        labels = cluster_trip_ids(
+            origin, destination, minutes[positions], radius_m, window_minutes
+        )
+        df.iloc[positions, df.columns.get_loc("cluster_id")] = labels + next_cluster_id
+        next_cluster_id += labels.max() + 1
+
+    df["origin_latitude"], df["origin_longitude"] = origin_lat, origin_lon
+    df["destination_latitude"] = destination_lat
+    df["destination_longitude"] = destination_lon
+
+    return df
@@ -0,0 +1,10 @@
+-- Small aggregate used to render the matplotlib charts.
+-- Day of week and month are derived from trip_date in Python.
+SELECT
+    DATE(datetime) AS trip_date,
+    EXTRACT(HOUR FROM datetime) AS hour,
+    region,
+    datasource,
+    COUNT(*) AS trip_count
+FROM `data-project-452300.challenge.raw_trips`
+GROUP BY 1,2,3,4;
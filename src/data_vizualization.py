@@ -1,7 +1,14 @@
+import argparse
 import os
 import pandas as pd
 from google.cloud import bigquery
 from google.oauth2 import service_account
+from local_mirror import (
+    LOCAL_MIRROR_DIR,
+    local_mirror_is_current,
+    read_local_mirror,
+    trips_query,
+)
 
 # load credentials
 PROJECT_ID = "data-project-452300"
@@ -10,19 +17,52 @@ TABLE_NAME = "raw_trips"
 TABLE_ID = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_NAME}"
 SERVICE_ACCOUNT_FILE = "data-project-452300-e2c341ffd483.json"
 
-# authenticate with Google Cloud
-credentials = service_account.Credentials.from_service_account_file(
-    SERVICE_ACCOUNT_FILE
-)
-bq_client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
+# columns used by the reports
+COLUMNS = ["region", "datetime", "datasource"]
+
+bq_client = None
+
+
+def get_bq_client():
+    """Authenticates with Google Cloud only when a query is really needed."""
+    global bq_client
 
+    if bq_client is None:
+        credentials = service_account.Credentials.from_service_account_file(
+            SERVICE_ACCOUNT_FILE
+        )
+        bq_client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
+    return bq_client
 
-def query_bigquery_table(query):
+
+def query_bigquery_table(query, job_config=None):
     """Runs a SQL query on BigQuery and returns results as a DataFrame."""
-    query_job = bq_client.query(query)  # run the query
+    query_job = get_bq_client().query(query, job_config=job_config)  # run the query
     return query_job.to_dataframe()  # convert result to Pandas DataFrame
 
 
+def load_trips(start_date=None, end_date=None, regions=None, source="auto"):
+    """
+    Loads the report columns from the local Parquet copy when it is up to date
+    with raw_trips (or source="local"), otherwise from BigQuery. Filters are
+    pushed down to both.
+    """
+
+    if source == "auto":
+        current = local_mirror_is_current(get_bq_client(), TABLE_ID)
+        source = "local" if current else "bigquery"
+
+    if source == "local":
+        print(f"🔹 Reading local Parquet copy {LOCAL_MIRROR_DIR}.")
+        return read_local_mirror(
+            columns=COLUMNS, start_date=start_date, end_date=end_date, regions=regions
+        )
+
+    return query_bigquery_table(
+        *trips_query(TABLE_ID, COLUMNS, start_date, end_date, regions)
+    )
+
+
 def print_report(title, data):
     """Formats the report for better readability."""
     print("\n\n" + "=" * 80)
@@ -36,16 +76,33 @@ def print_report(title, data):
         print(data)
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Trip reports in the console.")
+    parser.add_argument(
+        "--source", default="auto", choices=["auto", "bigquery", "local"]
+    )
+    parser.add_argument("--start-date", help="first date (inclusive), YYYY-MM-DD")
+    parser.add_argument("--end-date", help="last date (inclusive), YYYY-MM-DD")
+    parser.add_argument(
+        "--region", action="append", dest="regions", help="region (repeatable)"
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
 
+    args = parse_args()
+
     print("\n\n##################################################################")
     print("\n🔹 Selecting table for Data Visualization.")
 
-    # query to get all records from trips table
-    query = f"SELECT * FROM `{TABLE_ID}`"  # adjust limit if needed
-
-    # run query and store results in a DataFrame
-    df = query_bigquery_table(query)
+    # load the report columns of the selected dates and regions
+    df = load_trips(
+        start_date=args.start_date,
+        end_date=args.end_date,
+        regions=args.regions,
+        source=args.source,
+    )
 
     print("🔹 Table loaded into memory.")
 
@@ -1,8 +1,28 @@
-import matplotlib.pyplot as plt
+"""
+Matplotlib charts for the raw_trips table.
+
+By default the charts are shown one by one on screen. With --headless every chart
+(per region, datasource, hour, weekday and month) is written to image files instead,
+so the script can run inside Docker or as a batch job for many regions and date
+ranges. The charts are drawn from a small aggregate of raw_trips that is cached on
+disk, so re-rendering after a style change does not query BigQuery again.
+"""
+
+import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib.pyplot as plt
 import pandas as pd
+from matplotlib.figure import Figure
 from google.cloud import bigquery
 from google.oauth2 import service_account
+from local_mirror import (
+    LOCAL_MIRROR_DIR,
+    local_mirror_is_current,
+    local_mirror_modified,
+    read_local_mirror,
+)
 
 # load credentials
 PROJECT_ID = "data-project-452300"
@@ -11,104 +31,335 @@ TABLE_NAME = "raw_trips"
 TABLE_ID = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_NAME}"
 SERVICE_ACCOUNT_FILE = "data-project-452300-e2c341ffd483.json"
 
-# authenticate with Google Cloud
-credentials = service_account.Credentials.from_service_account_file(
-    SERVICE_ACCOUNT_FILE
-)
-bq_client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
+# headless rendering
+AGGREGATE_SQL_FILE = os.path.join("sql", "trip_counts_for_charts.sql")
+CACHE_DIR = "cache"
+OUTPUT_DIR = "charts"
+ALL_REGIONS = "all_regions"
+
+# chart name -> (column, plot kind, color, x label, title)
+CHARTS = {
+    "region": ("region", "bar", "blue", "Region", "🚖 Total Trips per Region"),
+    "datasource": (
+        "datasource",
+        "bar",
+        "green",
+        "Datasource",
+        "📡 Total Trips per Datasource",
+    ),
+    "hour": ("hour", "line", None, "Hour of the Day", "⏳ Trips per Hour of the Day"),
+    "day_of_week": (
+        "day_of_week",
+        "bar",
+        "purple",
+        "Day of the Week",
+        "📅 Trips per Day of the Week",
+    ),
+    "month": ("month", "bar", "orange", "Month", "📆 Trips per Month"),
+}
+
+bq_client = None
+
+
+def get_bq_client():
+    """Authenticates with Google Cloud only when a query is really needed."""
+    global bq_client
+
+    if bq_client is None:
+        credentials = service_account.Credentials.from_service_account_file(
+            SERVICE_ACCOUNT_FILE
+        )
+        bq_client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
+    return bq_client
 
 
 def query_bigquery_table(query):
     """Runs a SQL query on BigQuery and returns results as a DataFrame."""
-    query_job = bq_client.query(query)  # run the query
+    query_job = get_bq_client().query(query)  # run the query
     return query_job.to_dataframe()  # convert result to Pandas DataFrame
 
 
+def aggregate_local_mirror():
+    """Builds the chart aggregate from the local Parquet copy of raw_trips."""
+
+    trips = read_local_mirror(columns=["region", "datetime", "datasource"])
+    trips["datetime"] = pd.to_datetime(trips["datetime"])
+
+    return (
+        trips.groupby(
+            [
+                trips["datetime"].dt.normalize().rename("trip_date"),
+                trips["datetime"].dt.hour.rename("hour"),
+                "region",
+                "datasource",
+            ]
+        )
+        .size()
+        .rename("trip_count")
+        .reset_index()
+    )
+
+
+def latest_modification(source):
+    """
+    Returns when the data behind the aggregate last changed (as a Unix time):
+    the newest file of the local copy, or the raw_trips table in BigQuery.
+    The aggregate SQL file counts too, since editing it changes the aggregate.
+    """
+
+    modified_times = [os.path.getmtime(AGGREGATE_SQL_FILE)]
+
+    if source == "local":
+        modified_times.append(local_mirror_modified())
+    else:
+        # table metadata only, no query is run
+        table = get_bq_client().get_table(TABLE_ID)
+        modified_times.append(table.modified.timestamp())
+
+    return max(modified_times)
+
+
+def load_trip_counts(refresh=False, source="auto"):
+    """
+    Loads the chart aggregate from the local cache of the source. It is rebuilt
+    when the data or the SQL file changed since it was cached, from the local
+    Parquet copy when it is up to date with raw_trips (or source="local"),
+    otherwise from BigQuery.
+    """
+
+    if source == "auto":
+        current = local_mirror_is_current(get_bq_client(), TABLE_ID)
+        source = "local" if current else "bigquery"
+
+    cache_file = os.path.join(CACHE_DIR, f"trip_counts_for_charts_{source}.parquet")
+    data_modified = latest_modification(source)
+
+    if os.path.exists(cache_file) and not refresh:
+        if os.path.getmtime(cache_file) >= data_modified:
+            print(f"🔹 Using cached aggregate {cache_file}.")
+            return pd.read_parquet(cache_file)
+        print(f"🔹 Data changed since {cache_file} was cached, rebuilding it.")
+
+    if source == "local":
+        print(f"🔹 Reading local Parquet copy {LOCAL_MIRROR_DIR}.")
+        counts = aggregate_local_mirror()
+    else:
+        with open(AGGREGATE_SQL_FILE, "r") as sql_file:
+            query = sql_file.read()
+        counts = query_bigquery_table(query)
+
+    counts["trip_date"] = pd.to_datetime(counts["trip_date"])
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    counts.to_parquet(cache_file, index=False)
+
+    # the cache is as new as the data it was built from, so changes made while
+    # it was being built are picked up by the next run
+    os.utime(cache_file, (data_modified, data_modified))
+    print(f"🔹 Aggregate saved to {cache_file}.")
+
+    return counts
+
+
+def filter_trip_counts(counts, region=None, start_date=None, end_date=None):
+    """Selects the aggregate rows of one region and date range (inclusive)."""
+
+    mask = pd.Series(True, index=counts.index)
+    if region and region != ALL_REGIONS:
+        mask &= counts["region"] == region
+    if start_date:
+        mask &= counts["trip_date"] >= pd.Timestamp(start_date)
+    if end_date:
+        mask &= counts["trip_date"] <= pd.Timestamp(end_date)
+
+    return counts.loc[mask]
+
+
+def chart_series(counts):
+    """Sums the aggregate into one small Series per chart."""
+
+    counts = counts.assign(
+        day_of_week=counts["trip_date"].dt.day_name(),
+        month=counts["trip_date"].dt.month_name(),
+    )
+
+    series = {}
+    for name, (column, kind, _, _, _) in CHARTS.items():
+        totals = counts.groupby(column)["trip_count"].sum()
+        if kind == "line":
+            series[name] = totals.sort_index()
+        else:
+            series[name] = totals.sort_values(ascending=False)
+    return series
+
+
+def draw_chart(ax, name, data):
+    """Draws one chart on the given axes."""
+
+    _, kind, color, xlabel, title = CHARTS[name]
+
+    if kind == "line":
+        ax.plot(data.index, data.values, marker="o", linestyle="-")
+        ax.set_xticks(range(0, 24))
+    else:
+        ax.bar(data.index.astype(str), data.values, color=color)
+        ax.tick_params(axis="x", labelrotation=45)
+
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel("Number of Trips")
+    ax.set_title(title)
+    ax.grid(axis="y", linestyle="--", alpha=0.7)
+
+
+def render_chart(name, data, output_path):
+    """Saves a single chart to file. Runs in a worker process."""
+
+    fig = Figure(figsize=(10, 6))
+    draw_chart(fig.add_subplot(), name, data)
+    fig.tight_layout()
+    fig.savefig(output_path)
+    return output_path
+
+
+def render_report(series, title, output_path):
+    """Saves all charts of one region and date range as a multi-panel report."""
+
+    fig = Figure(figsize=(20, 18))
+    fig.suptitle(title, fontsize=16)
+    for position, (name, data) in enumerate(series.items(), start=1):
+        draw_chart(fig.add_subplot(3, 2, position), name, data)
+    fig.tight_layout()
+    fig.savefig(output_path)
+    return output_path
+
+
+def show_charts(series):
+    """Shows each chart on screen, one after the other."""
+
+    for name, data in series.items():
+        plt.figure(figsize=(10, 6))
+        draw_chart(plt.gca(), name, data)
+        plt.show()
+
+
+def render_batch(
+    counts,
+    regions,
+    date_ranges,
+    output_dir=OUTPUT_DIR,
+    image_format="png",
+    report=False,
+    workers=None,
+):
+    """
+    Writes the charts of every region and date range to files, rendering the
+    figures in parallel worker processes. Returns the list of written files.
+    """
+
+    jobs = []
+    for start_date, end_date in date_ranges:
+        range_label = f"{start_date or 'start'}_{end_date or 'end'}"
+
+        for region in regions:
+            filtered = filter_trip_counts(counts, region, start_date, end_date)
+            if filtered.empty:
+                print(f"🔹 No trips for {region} ({range_label}), skipping.")
+                continue
+
+            series = chart_series(filtered)
+
+            if report:
+                os.makedirs(output_dir, exist_ok=True)
+                output_path = os.path.join(
+                    output_dir, f"{region}_{range_label}.{image_format}"
+                )
+                title = f"Trips report - {region} ({range_label})"
+                jobs.append((render_report, (series, title, output_path)))
+                continue
+
+            chart_dir = os.path.join(output_dir, range_label, region)
+            os.makedirs(chart_dir, exist_ok=True)
+            for name, data in series.items():
+                output_path = os.path.join(chart_dir, f"{name}.{image_format}")
+                jobs.append((render_chart, (name, data, output_path)))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(function, *args) for function, args in jobs]
+        return [future.result() for future in futures]
+
+
+def parse_date_range(value):
+    """Parses 'START:END' (either side may be empty) into a tuple of dates."""
+
+    start_date, _, end_date = value.partition(":")
+    return start_date or None, end_date or None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Trip charts with matplotlib.")
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="write charts to files instead of showing them",
+    )
+    parser.add_argument(
+        "--report",
+        action="store_true",
+        help="write one multi-panel report per region and date range",
+    )
+    parser.add_argument("--format", default="png", choices=["png", "svg"])
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    parser.add_argument(
+        "--region",
+        action="append",
+        dest="regions",
+        help=f"region to render (repeatable), '{ALL_REGIONS}' for every trip",
+    )
+    parser.add_argument(
+        "--date-range",
+        action="append",
+        dest="date_ranges",
+        type=parse_date_range,
+        help="START:END dates, e.g. 2018-05-01:2018-05-31 (repeatable)",
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--refresh", action="store_true", help="rebuild the cached aggregate"
+    )
+    parser.add_argument(
+        "--source", default="auto", choices=["auto", "bigquery", "local"]
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
 
+    args = parse_args()
+
     print("\n##################################################################")
 
-    print("🔹 Select table for Data Vizualization.")
-
-    # query to get all records from trips table
-    query = f"SELECT * FROM `{TABLE_ID}`"  # limit to avoid excessive data
-
-    # run query and store results in a DataFrame
-    df = query_bigquery_table(query)
-
-    print("🔹 Table loaded into memory.")
-
-    # convert datetime column to pandas datetime format
-    df["datetime"] = pd.to_datetime(df["datetime"])
-
-    # Extract relevant time-based features
-    df["hour"] = df["datetime"].dt.hour
-    df["day_of_week"] = df["datetime"].dt.day_name()
-    df["month"] = df["datetime"].dt.month_name()
-
-    # count trips per region
-    region_counts = df["region"].value_counts()
-
-    # count trips per datasource
-    datasource_counts = df["datasource"].value_counts()
-
-    # count trips per hour of the day
-    hourly_counts = df["hour"].value_counts().sort_index()
-
-    # count trips per day of the week
-    day_of_week_counts = df["day_of_week"].value_counts()
-
-    # count trips per month
-    month_counts = df["month"].value_counts()
-
-    print("🔹 Creating matplotlib charts.")
-
-    # plot Trips per Region
-    plt.figure(figsize=(10, 6))
-    plt.bar(region_counts.index, region_counts.values, color="blue")
-    plt.xlabel("Region")
-    plt.ylabel("Number of Trips")
-    plt.title("🚖 Total Trips per Region")
-    plt.xticks(rotation=45)
-    plt.grid(axis="y", linestyle="--", alpha=0.7)
-    plt.show()
-
-    # plot Trips per Datasource
-    plt.figure(figsize=(10, 6))
-    plt.bar(datasource_counts.index, datasource_counts.values, color="green")
-    plt.xlabel("Datasource")
-    plt.ylabel("Number of Trips")
-    plt.title("📡 Total Trips per Datasource")
-    plt.xticks(rotation=45)
-    plt.grid(axis="y", linestyle="--", alpha=0.7)
-    plt.show()
-
-    # plot Trips per Hour of the Day
-    plt.figure(figsize=(10, 6))
-    plt.plot(hourly_counts.index, hourly_counts.values, marker="o", linestyle="-")
-    plt.xlabel("Hour of the Day")
-    plt.ylabel("Number of Trips")
-    plt.title("⏳ Trips per Hour of the Day")
-    plt.xticks(range(0, 24))
-    plt.grid(axis="y", linestyle="--", alpha=0.7)
-    plt.show()
-
-    # plot Trips per Day of the Week
-    plt.figure(figsize=(10, 6))
-    plt.bar(day_of_week_counts.index, day_of_week_counts.values, color="purple")
-    plt.xlabel("Day of the Week")
-    plt.ylabel("Number of Trips")
-    plt.title("📅 Trips per Day of the Week")
-    plt.xticks(rotation=45)
-    plt.grid(axis="y", linestyle="--", alpha=0.7)
-    plt.show()
-
-    # plot Trips per Month
-    plt.figure(figsize=(10, 6))
-    plt.bar(month_counts.index, month_counts.values, color="orange")
-    plt.xlabel("Month")
-    plt.ylabel("Number of Trips")
-    plt.title("📆 Trips per Month")
-    plt.xticks(rotation=45)
-    plt.grid(axis="y", linestyle="--", alpha=0.7)
-    plt.show()
+    print("🔹 Select aggregate for Data Vizualization.")
+
+    counts = load_trip_counts(refresh=args.refresh, source=args.source)
+
+    print("🔹 Aggregate loaded into memory.")
+
+    if not args.headless:
+        print("🔹 Creating matplotlib charts.")
+        show_charts(chart_series(counts))
+
+    else:
+        regions = args.regions or [ALL_REGIONS] + sorted(counts["region"].unique())
+        date_ranges = args.date_ranges or [(None, None)]
+
+        print("🔹 Rendering matplotlib charts to files.")
+        written = render_batch(
+            counts,
+            regions,
+            date_ranges,
+            output_dir=args.output_dir,
+            image_format=args.format,
+            report=args.report,
+            workers=args.workers,
+        )
+        print(f"🔹 {len(written)} chart files written to {args.output_dir}.")
@@ -0,0 +1,229 @@
+"""
+Local copy of raw_trips as a hive-partitioned Parquet dataset.
+
+The layout mirrors the BigQuery table (PARTITION BY DATE(datetime) CLUSTER BY region):
+
+    data/raw_trips/date=2018-05-28/region=Prague/<file>.parquet
+
+Readers only open the files of the requested dates and regions and only read the
+requested columns, so scoped reports and offline runs don't need BigQuery. The
+same filters are built as a parameterized query for reads from BigQuery.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import uuid
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+
+LOCAL_MIRROR_DIR = os.path.join("data", "raw_trips")
+COMPRESSION = "zstd"
+COMPACT_MIN_FILES = 8  # partitions with more files than this are compacted
+COMPACTED_FROM = b"compacted_from"  # Parquet metadata with the merged file names
+
+# partition columns are always read as strings, ISO dates compare correctly
+PARTITIONING = ds.partitioning(
+    pa.schema([("date", pa.string()), ("region", pa.string())]), flavor="hive"
+)
+
+
+def write_local_mirror(df, base_dir=LOCAL_MIRROR_DIR, basename=None):
+    """
+    Appends a processed chunk of trips to the local Parquet dataset.
+    Writing again with the same basename overwrites the files of that chunk.
+    """
+
+    df = df.assign(date=pd.to_datetime(df["datetime"]).dt.strftime("%Y-%m-%d"))
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    # a unique file name per chunk, so appends never overwrite earlier chunks
+    # (a fixed basename makes writing the same chunk again idempotent)
+    ds.write_dataset(
+        table,
+        base_dir,
+        format="parquet",
+        partitioning=PARTITIONING,
+        basename_template=f"part-{basename or uuid.uuid4().hex}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        file_options=ds.ParquetFileFormat().make_write_options(
+            compression=COMPRESSION
+        ),
+    )
+
+
+def start_local_mirror_rebuild(base_dir=LOCAL_MIRROR_DIR):
+    """
+    Starts a full rebuild of the local copy, like CREATE OR REPLACE of raw_trips.
+    Chunks are written to the returned temporary folder, and readers keep seeing
+    the previous copy until finish_local_mirror_rebuild swaps it in.
+    """
+
+    temp_dir = f"{base_dir}.rebuild"
+    shutil.rmtree(temp_dir, ignore_errors=True)  # leftovers of an interrupted run
+    os.makedirs(temp_dir)
+    return temp_dir
+
+
+def finish_local_mirror_rebuild(temp_dir, base_dir=LOCAL_MIRROR_DIR):
+    """Replaces the local copy with the rebuilt one."""
+
+    old_dir = f"{base_dir}.old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(base_dir):
+        os.replace(base_dir, old_dir)
+    os.replace(temp_dir, base_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def compact_local_mirror(base_dir=LOCAL_MIRROR_DIR, min_files=COMPACT_MIN_FILES):
+    """
+    Merges the small files of each partition (written by micro-batches) into one.
+    The merged file records its source files in the Parquet metadata, so sources
+    left behind by an interrupted compaction are removed on the next run.
+    """
+
+    for partition_dir, _, file_names in os.walk(base_dir):
+        # temp files of an interrupted compaction hold rows that are still in
+        # their sources, so they are deleted and never merged
+        for name in file_names:
+            if name.startswith("_compact-"):
+                os.remove(os.path.join(partition_dir, name))
+
+        paths = sorted(
+            os.path.join(partition_dir, name)
+            for name in file_names
+            if name.endswith(".parquet") and not name.startswith("_")
+        )
+
+        # finish interrupted compactions (sources are older than the merged file,
+        # a newer file with the same name is new data and is kept)
+        for path in paths:
+            if os.path.basename(path).startswith("compact-") and os.path.exists(path):
+                metadata = pq.read_schema(path).metadata or {}
+                for source in json.loads(metadata.get(COMPACTED_FROM, b"[]")):
+                    source_path = os.path.join(partition_dir, source)
+                    if os.path.exists(source_path) and os.path.getmtime(
+                        source_path
+                    ) <= os.path.getmtime(path):
+                        os.remove(source_path)
+        paths = [path for path in paths if os.path.exists(path)]
+
+        if len(paths) <= min_files:
+            continue
+
+        sources = [os.path.basename(path) for path in paths]
+        table = pa.concat_tables(
+            [pq.read_table(path, partitioning=None) for path in paths],
+            promote_options="default",
+        )
+        table = table.replace_schema_metadata(
+            {**(table.schema.metadata or {}), COMPACTED_FROM: json.dumps(sources)}
+        )
+
+        # files starting with "_" are ignored by readers until renamed
+        digest = hashlib.sha1(",".join(sources).encode()).hexdigest()[:16]
+        temp_path = os.path.join(partition_dir, f"_compact-{digest}.parquet")
+        pq.write_table(table, temp_path, compression=COMPRESSION)
+        os.replace(temp_path, os.path.join(partition_dir, f"compact-{digest}.parquet"))
+
+        for path in paths:
+            os.remove(path)
+
+
+def local_mirror_exists(base_dir=LOCAL_MIRROR_DIR):
+    """Checks if the local Parquet dataset was written."""
+    return os.path.isdir(base_dir) and any(os.scandir(base_dir))
+
+
+def local_mirror_modified(base_dir=LOCAL_MIRROR_DIR):
+    """Returns when the local copy last changed, as the Unix time of its newest file."""
+
+    modified_times = [0]
+    for directory, _, file_names in os.walk(base_dir):
+        modified_times.append(os.path.getmtime(directory))
+        modified_times.extend(
+            os.path.getmtime(os.path.join(directory, name)) for name in file_names
+        )
+    return max(modified_times)
+
+
+def local_mirror_is_current(bq_client, table_id, base_dir=LOCAL_MIRROR_DIR):
+    """
+    Checks if the local copy exists and changed after the BigQuery table (table
+    metadata only, no query is run). Batch runs and watch mode without
+    --local-mirror change raw_trips but not the copy, which is then out of date.
+    """
+
+    if not local_mirror_exists(base_dir):
+        return False
+    table = bq_client.get_table(table_id)
+    return local_mirror_modified(base_dir) >= table.modified.timestamp()
+
+
+def read_local_mirror(
+    base_dir=LOCAL_MIRROR_DIR,
+    columns=None,
+    start_date=None,
+    end_date=None,
+    regions=None,
+):
+    """
+    Reads trips from the local Parquet dataset into a DataFrame.
+    Date (inclusive) and region filters prune partitions, and only the
+    requested columns are read from the files.
+    """
+
+    dataset = ds.dataset(base_dir, format="parquet", partitioning=PARTITIONING)
+
+    # dates, datetimes and strings are compared as the YYYY-MM-DD partition value
+    expression = ds.scalar(True)
+    if start_date:
+        start_date = pd.Timestamp(start_date).strftime("%Y-%m-%d")
+        expression &= ds.field("date") >= start_date
+    if end_date:
+        end_date = pd.Timestamp(end_date).strftime("%Y-%m-%d")
+        expression &= ds.field("date") <= end_date
+    if regions:
+        expression &= ds.field("region").isin(list(regions))
+
+    if columns is None:
+        columns = [name for name in dataset.schema.names if name != "date"]
+
+    table = dataset.to_table(columns=columns, filter=expression)
+    return table.to_pandas()
+
+
+def trips_query(table_id, columns=None, start_date=None, end_date=None, regions=None):
+    """
+    Builds the BigQuery query (and its job config) that reads the same trips as
+    read_local_mirror: date (inclusive) and region filters and the column list.
+    """
+
+    conditions = []
+    query_parameters = []
+    if start_date:
+        conditions.append("DATE(datetime) >= @start_date")
+        query_parameters.append(
+            bigquery.ScalarQueryParameter("start_date", "DATE", start_date)
+        )
+    if end_date:
+        conditions.append("DATE(datetime) <= @end_date")
+        query_parameters.append(
+            bigquery.ScalarQueryParameter("end_date", "DATE", end_date)
+        )
+    if regions:
+        conditions.append("region IN UNNEST(@regions)")
+        query_parameters.append(
+            bigquery.ArrayQueryParameter("regions", "STRING", list(regions))
+        )
+
+    query = f"SELECT {', '.join(columns) if columns else '*'} FROM `{table_id}`"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+
+    return query, bigquery.QueryJobConfig(query_parameters=query_parameters)
@@ -4,15 +4,27 @@ a CSV file into Google BigQuery, ensuring scalability and efficiency through bat
 processing and partitioning.
 """
 
+import argparse
+import io
+import json
 import os
 import re
 import time
+import uuid
 import warnings
 import pandas as pd
 from tqdm import tqdm
 from dotenv import load_dotenv
+from google.api_core.exceptions import NotFound
 from google.cloud import bigquery
 from google.oauth2 import service_account
+from local_mirror import (
+    LOCAL_MIRROR_DIR,
+    compact_local_mirror,
+    finish_local_mirror_rebuild,
+    start_local_mirror_rebuild,
+    write_local_mirror,
+)
 
 # variables
 PROJECT_ID = "data-project-452300"
@@ -23,6 +35,15 @@ SERVICE_ACCOUNT_FILE = r"data-project-452300-e2c341ffd483.json"
 FILE_PATH = "trips.csv"
 CHUNK_SIZE = 100000  # load data in chuncks
 
+# watch mode (micro-batch ingestion of new CSV files)
+WATCH_BATCH_SIZE = 10000  # max rows per micro-batch
+WATCH_MAX_LATENCY = 30  # max seconds a row waits before its micro-batch is loaded
+WATCH_POLL_INTERVAL = 2  # seconds between directory scans
+WATCH_STATE_FILE = ".ingestion_state.json"  # processed byte offset of each file
+WATCH_FAILED_DIR = "failed"  # rows of micro-batches that could not be loaded
+WATCH_MAX_RETRIES = 5  # load attempts before a micro-batch is set aside
+WATCH_COMPACT_INTERVAL = 600  # seconds between compactions of the local copy
+
 # set GCP credentials
 credentials = service_account.Credentials.from_service_account_file(
     SERVICE_ACCOUNT_FILE
@@ -43,8 +64,13 @@ def create_bq_table(ddl_file):
     query_job.result()
 
 
-def load_table_to_bigquery(df, table_id):
-    """Append data from DataFrame to BigQuery in chunks for scalability."""
+def load_table_to_bigquery(df, table_id, raise_errors=False, job_id=None):
+    """
+    Append data from DataFrame to BigQuery in chunks for scalability.
+    With raise_errors the failure is raised, so the caller can retry the chunk.
+    With job_id, a job that already ran with that id is awaited instead of
+    loading the chunk again, which makes the load idempotent across restarts.
+    """
 
     start_time = time.time()
 
@@ -54,7 +80,17 @@ def load_table_to_bigquery(df, table_id):
             autodetect=True,  # automatically detect schema
         )
 
-        job = bq_client.load_table_from_dataframe(df, table_id, job_config=job_config)
+        job = None
+        if job_id:
+            try:
+                job = bq_client.get_job(job_id)
+            except NotFound:
+                pass
+
+        if job is None:
+            job = bq_client.load_table_from_dataframe(
+                df, table_id, job_config=job_config, job_id=job_id
+            )
         job.result()
 
         duration = time.time() - start_time
@@ -62,14 +98,59 @@ def load_table_to_bigquery(df, table_id):
 
     except Exception as e:
         print(f"🔹Failed to upload table chunk: {e}")
+        if raise_errors:
+            raise
         return 0  # return a default value instead of None
 
 
-def data_ingestion(file_path):
-    """Loads chunks and processes information efficiently."""
+def load_job_outcome(job_id, poll_interval=WATCH_POLL_INTERVAL):
+    """
+    Checks a load job whose result could not be read, waiting while it runs.
+    Returns True when it loaded the rows, False when it failed (or was never
+    created) and None when its state can't be read right now.
+    """
+
+    try:
+        job = bq_client.get_job(job_id)
+        while not job.done():  # reloads the job state
+            time.sleep(poll_interval)
+    except NotFound:
+        return False
+    except Exception as e:
+        print(f"🔹Failed to check load job {job_id}: {e}")
+        return None
+
+    return job.error_result is None
+
+
+def transform_chunk(chunk):
+    """Converts datetime and fixes the coordinates of a chunk of trips."""
+
+    chunk["datetime"] = pd.to_datetime(chunk["datetime"])  # convert datetime
+
+    chunk["origin_coord"] = chunk["origin_coord"].apply(
+        clean_coordinates
+    )  # fix origin coordinates
+
+    chunk["destination_coord"] = chunk["destination_coord"].apply(
+        clean_coordinates
+    )  # fix destination coordinates
+
+    return chunk
+
+
+def data_ingestion(file_path, local_mirror_dir=None):
+    """
+    Loads chunks and processes information efficiently.
+    When local_mirror_dir is set, the local Parquet copy is rebuilt with the chunks
+    that were loaded to BigQuery, since raw_trips is recreated by the batch run.
+    """
 
     print("\n\n🔹 Starting data ingestion for trips.csv")
 
+    if local_mirror_dir:
+        rebuild_dir = start_local_mirror_rebuild(local_mirror_dir)
+
     total_rows = (
         sum(1 for _ in open(file_path)) - 1
     )  # estimate total rows (minus header)
@@ -84,24 +165,25 @@ def data_ingestion(file_path):
 
         for chunk in pd.read_csv(file_path, chunksize=CHUNK_SIZE):
 
-            chunk["datetime"] = pd.to_datetime(chunk["datetime"])  # convert datetime
-
-            chunk["origin_coord"] = chunk["origin_coord"].apply(
-                clean_coordinates
-            )  # fix origin coordinates
+            chunk = transform_chunk(chunk)  # convert datetime and fix coordinates
 
-            chunk["destination_coord"] = chunk["destination_coord"].apply(
-                clean_coordinates
-            )  # fix destination coordinates
-
-            processing_time = load_table_to_bigquery(
-                chunk, TABLE_ID
-            )  # load chuck data to BigQuery
+            try:
+                processing_time = load_table_to_bigquery(
+                    chunk, TABLE_ID, raise_errors=True
+                )  # load chuck data to BigQuery
+            except Exception:
+                processing_time = 0  # not in raw_trips, so not in the local copy
+            else:
+                if local_mirror_dir:
+                    write_local_mirror(chunk, rebuild_dir)  # local Parquet copy
 
             pbar.update(1)  # update progress bar
 
             pbar.set_postfix({"Last Batch Time": f"{processing_time:.2f}s"})
 
+    if local_mirror_dir:
+        finish_local_mirror_rebuild(rebuild_dir, local_mirror_dir)
+
     time.sleep(1)
     print("🔹 Data ingestion completed successfully.")
 
@@ -117,12 +199,329 @@ def clean_coordinates(coord):
         return None  # replace possible errors
 
 
+def load_watch_state(state_path):
+    """
+    Loads the watch state: the loaded byte offset of each file and the micro-batch
+    that was being loaded when the watcher stopped, if any.
+    """
+
+    if not os.path.exists(state_path):
+        return {"offsets": {}, "in_flight": None}
+    with open(state_path, "r") as state_file:
+        return json.load(state_file)
+
+
+def save_watch_state(state, state_path):
+    """Saves the state atomically, so a crash never leaves a broken state file."""
+
+    temp_path = f"{state_path}.tmp"
+    with open(temp_path, "w") as state_file:
+        json.dump(state, state_file, indent=2)
+    os.replace(temp_path, state_path)
+
+
+def list_input_files(input_dir):
+    """Lists the CSV files of the input directory, oldest first."""
+
+    modified_times = {}
+    for name in os.listdir(input_dir):
+        if name.endswith(".csv"):
+            try:
+                modified_times[name] = os.path.getmtime(os.path.join(input_dir, name))
+            except FileNotFoundError:
+                pass  # archived by the producer in the meantime
+    return sorted(modified_times, key=modified_times.get)
+
+
+def read_new_rows(file_path, offset, max_rows):
+    """
+    Reads up to max_rows complete lines written after offset. A last line without
+    a line break is still being written, so it is left for the next scan.
+    Returns the header, the new lines and the offsets before and after them.
+    """
+
+    with open(file_path, "rb") as csv_file:
+        header = csv_file.readline()
+        if not header.endswith(b"\n"):
+            return header, [], offset, offset  # header not fully written yet
+
+        # start after the header, or from the beginning if the file was replaced
+        if offset < len(header) or offset > os.fstat(csv_file.fileno()).st_size:
+            offset = len(header)
+        csv_file.seek(offset)
+
+        start = offset
+        lines = []
+        while len(lines) < max_rows:
+            line = csv_file.readline()
+            if not line.endswith(b"\n"):
+                break
+            lines.append(line)
+            offset += len(line)
+
+    return header, lines, start, offset
+
+
+def read_rows_range(file_path, start, end):
+    """Reads the header and the lines between two byte offsets of a file."""
+
+    with open(file_path, "rb") as csv_file:
+        header = csv_file.readline()
+        csv_file.seek(start)
+        lines = csv_file.read(end - start).splitlines(keepends=True)
+    return header, lines
+
+
+def set_aside_batch(batch, input_dir, reason):
+    """Writes the rows of a micro-batch that can't be loaded to the failed folder."""
+
+    reason = str(reason).splitlines()[0]  # first line of the error is enough
+
+    failed_dir = os.path.join(input_dir, WATCH_FAILED_DIR)
+    os.makedirs(failed_dir, exist_ok=True)
+
+    for file_name, header, lines, start, end in batch:
+        failed_path = os.path.join(
+            failed_dir, f"{os.path.splitext(file_name)[0]}_{start}-{end}.csv"
+        )
+        with open(failed_path, "wb") as failed_file:
+            failed_file.write(header + b"".join(lines))
+        print(f"🔹 Set aside rows {start}-{end} of {file_name} ({reason})")
+
+
+def watch_directory(
+    input_dir,
+    batch_size=WATCH_BATCH_SIZE,
+    max_latency=WATCH_MAX_LATENCY,
+    poll_interval=WATCH_POLL_INTERVAL,
+    local_mirror_dir=None,
+):
+    """
+    Watches a directory for new CSV files (and rows appended to them) and loads
+    the new rows to BigQuery in micro-batches. A micro-batch is loaded when it has
+    batch_size rows or when its oldest row waited max_latency seconds.
+
+    Before a micro-batch is loaded, its byte ranges and id are saved as
+    "in_flight", and its BigQuery job id is derived from them. After a crash the
+    same micro-batch is replayed with the same job id (and the same local copy
+    file names), so it is not appended twice. Rows that can't be parsed, or that
+    fail to load WATCH_MAX_RETRIES times, are set aside in the failed folder and
+    skipped.
+    """
+
+    state_path = os.path.join(input_dir, WATCH_STATE_FILE)
+    state = load_watch_state(state_path)
+    offsets = dict(state["offsets"])  # offsets of rows already read
+
+    pending = []  # (file_name, header, lines, start, end) read since the last load
+    pending_rows = 0
+    oldest_row_time = None
+    last_compaction = time.monotonic()
+
+    def commit(batch):
+        """Moves the saved offsets past the batch and clears the in-flight batch."""
+        for file_name, _, _, _, end in batch:
+            state["offsets"][file_name] = end
+        state["in_flight"] = None
+        save_watch_state(state, state_path)
+
+    def load(batch, attempt):
+        """Loads a micro-batch. Returns True when it is loaded or set aside."""
+
+        # a retried or replayed batch keeps the id saved before, so its job id
+        # (and local copy file names) are the same as in the earlier attempts
+        if not state.get("in_flight"):
+            state["in_flight"] = {
+                "batch_id": uuid.uuid4().hex,
+                "ranges": [[name, start, end] for name, _, _, start, end in batch],
+            }
+        state["in_flight"]["attempt"] = attempt
+        save_watch_state(state, state_path)
+        batch_id = state["in_flight"]["batch_id"]
+
+        # a file range with invalid rows is set aside, the other ranges are loaded
+        chunks = []
+        for entry in batch:
+            _, header, lines, _, _ = entry
+            try:
+                chunk = pd.read_csv(io.BytesIO(header + b"".join(lines)))
+                chunks.append(transform_chunk(chunk))  # datetime and coordinates
+            except Exception as e:
+                set_aside_batch([entry], input_dir, f"invalid rows: {e}")
+
+        if not chunks:
+            commit(batch)
+            return True
+        chunk = pd.concat(chunks, ignore_index=True)
+
+        job_id = f"raw_trips_watch_{batch_id}_{attempt}"
+        start_time = time.time()
+        try:
+            processing_time = load_table_to_bigquery(
+                chunk, TABLE_ID, raise_errors=True, job_id=job_id
+            )
+        except Exception as e:
+            # the job may still be running or may have loaded the rows even if
+            # its result could not be read, so a new job (with the next attempt
+            # in its id) is only started when this one really failed
+            job_loaded = load_job_outcome(job_id, poll_interval)
+            if job_loaded is None:
+                return False  # retried with the same job id
+            if not job_loaded:
+                if attempt + 1 >= WATCH_MAX_RETRIES:
+                    set_aside_batch(batch, input_dir, f"load failed: {e}")
+                    commit(batch)
+                    return True
+                state["in_flight"]["attempt"] = attempt + 1
+                save_watch_state(state, state_path)
+                return False
+            processing_time = time.time() - start_time
+
+        if local_mirror_dir:
+            write_local_mirror(chunk, local_mirror_dir, basename=batch_id)
+        commit(batch)
+
+        lag = time.monotonic() - oldest_row_time if oldest_row_time else 0
+        print(
+            f"🔹 Loaded {len(chunk)} rows in {processing_time:.2f}s "
+            f"(oldest row waited {lag:.2f}s)"
+        )
+        return True
+
+    def flush(attempt=0):
+        """Loads the pending rows, retrying until loaded or set aside."""
+        nonlocal pending, pending_rows, oldest_row_time
+
+        while not load(pending, attempt):
+            time.sleep(poll_interval * 2**attempt)  # back off before retrying
+            attempt = state["in_flight"]["attempt"]  # moved on by failed jobs
+
+        pending, pending_rows, oldest_row_time = [], 0, None
+
+    # replay the micro-batch that was being loaded when the watcher stopped
+    if state.get("in_flight"):
+        for file_name, start, end in state["in_flight"]["ranges"]:
+            try:
+                header, lines = read_rows_range(
+                    os.path.join(input_dir, file_name), start, end
+                )
+            except FileNotFoundError:
+                print(f"🔹 {file_name} was removed, its in-flight rows are skipped")
+                continue
+            pending.append((file_name, header, lines, start, end))
+
+        if pending:
+            flush(attempt=state["in_flight"]["attempt"])
+        else:
+            state["in_flight"] = None
+            save_watch_state(state, state_path)
+        offsets = dict(state["offsets"])
+
+    if local_mirror_dir:
+        compact_local_mirror(local_mirror_dir)  # also finishes interrupted runs
+
+    print(f"\n\n🔹 Watching {input_dir} for new trip files (Ctrl+C to stop)")
+
+    try:
+        while True:
+            for file_name in list_input_files(input_dir):
+                file_path = os.path.join(input_dir, file_name)
+
+                while True:
+                    try:
+                        header, lines, start, offset = read_new_rows(
+                            file_path,
+                            offsets.get(file_name, 0),
+                            batch_size - pending_rows,
+                        )
+                    except FileNotFoundError:
+                        break  # archived by the producer in the meantime
+                    if not lines:
+                        break
+
+                    pending.append((file_name, header, lines, start, offset))
+                    pending_rows += len(lines)
+                    offsets[file_name] = offset
+                    if oldest_row_time is None:
+                        oldest_row_time = time.monotonic()
+
+                    if pending_rows >= batch_size:
+                        flush()
+
+            if pending and time.monotonic() - oldest_row_time >= max_latency:
+                flush()
+
+            if (
+                local_mirror_dir
+                and time.monotonic() - last_compaction >= WATCH_COMPACT_INTERVAL
+            ):
+                compact_local_mirror(local_mirror_dir)
+                last_compaction = time.monotonic()
+
+            time.sleep(min(poll_interval, max_latency))
+
+    except KeyboardInterrupt:
+        if pending:
+            flush()  # load the rows already read before stopping
+        if local_mirror_dir:
+            compact_local_mirror(local_mirror_dir)
+        print("🔹 Watch mode stopped.")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="ETL of trips.csv to BigQuery.")
+    parser.add_argument(
+        "--local-mirror",
+        action="store_true",
+        help="also write a local Parquet copy partitioned by date and region",
+    )
+    parser.add_argument("--local-mirror-dir", default=LOCAL_MIRROR_DIR)
+    parser.add_argument(
+        "--watch",
+        metavar="INPUT_DIR",
+        help="watch a directory and load new CSV rows in micro-batches",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=WATCH_BATCH_SIZE,
+        help="max rows per micro-batch in watch mode",
+    )
+    parser.add_argument(
+        "--max-latency",
+        type=float,
+        default=WATCH_MAX_LATENCY,
+        help="max seconds a row waits before being loaded in watch mode",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=WATCH_POLL_INTERVAL,
+        help="seconds between directory scans in watch mode",
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
 
-    # create raw trip table with partition and clustering for better performance
-    create_bq_table(ddl_file="sql/ddl/trips_ddl.sql")
+    args = parse_args()
+    local_mirror_dir = args.local_mirror_dir if args.local_mirror else None
+
+    if args.watch:
+        # append new rows to the existing raw trip table, without recreating it
+        watch_directory(
+            args.watch,
+            batch_size=args.batch_size,
+            max_latency=args.max_latency,
+            poll_interval=args.poll_interval,
+            local_mirror_dir=local_mirror_dir,
+        )
+
+    else:
+        # create raw trip table with partition and clustering for better performance
+        create_bq_table(ddl_file="sql/ddl/trips_ddl.sql")
 
-    # make the ETL of table trips from CSV to Big Query
-    df = data_ingestion(FILE_PATH)
+        # make the ETL of table trips from CSV to Big Query
+        df = data_ingestion(FILE_PATH, local_mirror_dir=local_mirror_dir)
 
     table_id = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"